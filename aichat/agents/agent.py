@@ -1,11 +1,13 @@
 import asyncio
 from enum import StrEnum
+from functools import cache
+import threading
+import time
 from typing import Any, Protocol, Generator
 
 import flet as ft
 from loguru import logger
 
-import config
 from topics import Topics
 from models.message import Message, ContentType
 from models.role import Role
@@ -25,7 +27,22 @@ class Agent(Protocol):
     ) -> Generator[str, None, None]: ...
 
 
+@cache
+def _get_agent_loop() -> asyncio.AbstractEventLoop:
+    """Agentへのリクエストを実行するイベントループ. UIとは別のスレッドで動かし続ける
+
+    共有しているAPI clientの接続はループに紐づくので, リクエストごとに作り直さない
+    """
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="agent-loop", daemon=True).start()
+
+    return loop
+
+
 class AgentController:
+    # ストリーミング中に画面を更新する最短間隔(秒)
+    STREAM_UPDATE_INTERVAL = 0.05
+
     def __init__(self, page: ft.Page):
         self.page = page
         self.page.pubsub.subscribe_topic(
@@ -33,32 +50,47 @@ class AgentController:
             self.recieve_message,
         )
 
-    def recieve_message(self, topic: Topics, messages: list[Message]):
-        if messages[-1].role.name != config.USER_NAME:
-            return
-
+    async def recieve_message(self, topic: Topics, messages: list[Message]):
         logger.info(f"{self.__class__.__name__}: Request to agent...")
 
         agent: Agent = self.page.session.get("agent")
         chat_id: str = self.page.session.get("chat_id")
 
         request_func = self.stream_request if agent.streamable else self.batch_request
-        response_message = asyncio.run(request_func(chat_id, messages, agent))
+        # 応答を待つ間もスレッドを塞がないよう, Agentのループの完了をawaitする
+        response_message = await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(
+                request_func(chat_id, messages, agent), _get_agent_loop()
+            )
+        )
         response_message.insert_into_db()
 
     async def stream_request(
         self, chat_id: str, messages: list[Message], agent: Agent
     ) -> Message:
         response = ""
+        response_message = Message.construct_auto_file(
+            chat_id, response, response, agent.role, ContentType.TEXT
+        )
+        last_published = 0.0
         async for chunk in agent.request_streaming(messages):
             response += chunk
-            response_message = Message.construct_auto_file(
-                chat_id, response, response, agent.role, ContentType.TEXT
-            )
-
-            self.page.pubsub.send_all_on_topic(
-                Topics.UPDATE_MESSAGE_STREAMLY, response_message
-            )
+            # 同じMessageを使い回し、chunkごとにインスタンスを作らない
+            response_message.display_content = response
+            response_message.system_content = response
+
+            # chunkごとではなく一定間隔で画面を更新する
+            now = time.monotonic()
+            if now - last_published >= self.STREAM_UPDATE_INTERVAL:
+                last_published = now
+                self.page.pubsub.send_all_on_topic(
+                    Topics.UPDATE_MESSAGE_STREAMLY, response_message
+                )
+
+        # 間引かれた最後の部分を反映する
+        self.page.pubsub.send_all_on_topic(
+            Topics.UPDATE_MESSAGE_STREAMLY, response_message
+        )
 
         return response_message
 
@@ -1,4 +1,5 @@
 from enum import StrEnum
+from functools import cache
 import json
 import os
 
@@ -26,21 +27,27 @@ class ClaudeModel(StrEnum):
     CLAUDE37SONNET = "claude-3-7-sonnet-latest"
 
 
+# モデルを切り替えるたびにAgentが作られるので, HTTP接続を持つclientは共有する
+@cache
+def _get_client() -> anthropic.AsyncAnthropic:
+    return anthropic.AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
+
+
 class ClaudeAgent:
     MAX_TOKENS = 2048
 
     def __init__(self, model: ClaudeModel, mcp_handler: McpHandler):
         self.model = model
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
         self.streamable = True
-        self.client = anthropic.AsyncAnthropic(
-            api_key=os.environ.get("ANTHROPIC_API_KEY")
-        )
+        self.client = _get_client()
         self.mcp_handler = mcp_handler
 
     def _construct_request(self, message: Message) -> dict[str, Any]:
+        # 会話履歴は毎回まとめて送るので, 変換済みのリクエストをメッセージに持たせて使い回す
+        return message.cached_request("claude", self._build_request)
+
+    def _build_request(self, message: Message) -> dict[str, Any]:
         request = {"role": ("assistant" if message.is_assistant_message() else "user")}
 
         match message.content_type:
@@ -1,9 +1,10 @@
 from enum import StrEnum
+from functools import cache
 import os
 from typing import Any, AsyncGenerator
 
 from loguru import logger
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 import config
 from models.role import Role
@@ -15,23 +16,28 @@ class DeepSeekModel(StrEnum):
     DEEPSEEKREASONER = "deepseek-reasoner"
 
 
+@cache
+def _get_client() -> AsyncOpenAI:
+    # Use openai library
+    return AsyncOpenAI(
+        api_key=os.environ.get("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com",
+    )
+
+
 class DeepSeekAgent:
     def __init__(self, model: DeepSeekModel):
         self.model = model
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
 
         self.streamable = True
 
-        # Use openai library
-        self.client = OpenAI(
-            api_key=os.environ.get("DEEPSEEK_API_KEY"),
-            base_url="https://api.deepseek.com",
-        )
+        self.client = _get_client()
 
     def _construct_request(self, message: Message) -> dict[str, Any]:
-        request = {"role": ("assistant" if message.is_assistant_message else "user")}
+        request = {
+            "role": ("assistant" if message.is_assistant_message() else "user")
+        }
 
         match message.content_type:
             case ContentType.TEXT:
@@ -47,7 +53,7 @@ class DeepSeekAgent:
         logger.info("Sending message to DeepSeek...")
 
         request_body = [self._construct_request(m) for m in messages]
-        chat_completion = self.client.chat.completions.create(
+        chat_completion = await self.client.chat.completions.create(
             messages=request_body,
             model=self.model,
         )
@@ -64,11 +70,11 @@ class DeepSeekAgent:
         logger.info("Sending message to DeepSeek...")
 
         request_body = [self._construct_request(m) for m in messages]
-        chat_completion = self.client.chat.completions.create(
+        chat_completion = await self.client.chat.completions.create(
             messages=request_body,
             model=self.model,
             stream=True,
         )
-        for chunk in chat_completion:
+        async for chunk in chat_completion:
             if chunk.choices[0].delta.content:
                 yield chunk.choices[0].delta.content
@@ -18,9 +18,7 @@ class DummyAgent:
 
     def __init__(self, model: str):
         self.model = DummyModel.DUMMY
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
         self.streamable = False
 
     def _construct_request(self, message: Message) -> dict[str, Any]:
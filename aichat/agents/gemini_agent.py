@@ -1,4 +1,5 @@
 from enum import StrEnum
+from functools import cache
 import os
 from typing import Any, AsyncGenerator
 
@@ -19,17 +20,28 @@ class GeminiModel(StrEnum):
     GEMINI25PRO = "gemini-2.5-pro-preview-05-06"
 
 
+# モデルを切り替えるたびにAgentが作られるので, HTTP接続を持つclientは共有する
+@cache
+def _get_client() -> genai.Client:
+    return genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+
+
 class GeminiAgent:
     def __init__(self, model: GeminiModel, mcp_handler: McpHandler):
         self.model = model
-        self.role = Role(f"{config.AGENT_NAME} ({model})", config.AGENT_AVATAR_COLOR)
+        self.role = Role.intern(f"{config.AGENT_NAME} ({model})")
         self.mcp_handler = mcp_handler
 
         self.streamable = True
 
-        self.client = genai.Client(api_key=os.environ.get("GEMINI_API_KEY"))
+        self.client = _get_client()
 
     def _construct_request(self, message: Message) -> dict[str, Any]:
+        # 会話履歴は毎回まとめて送るので, 変換済みのリクエストをメッセージに持たせて使い回す
+        # 画像はBlobの作成時にbase64のデコードが走るので特に効く
+        return message.cached_request("gemini", self._build_request)
+
+    def _build_request(self, message: Message) -> dict[str, Any]:
         request = types.Content(
             role="model" if message.is_assistant_message() else "user"
         )
@@ -71,7 +83,7 @@ class GeminiAgent:
                     )
                 )
             request_body.append(self._construct_request(m))
-            logger.debug(f"request_body: {request_body}")
+            logger.debug("request_body: {}", request_body)
 
         cnt = 0
         final_content = []
@@ -150,9 +162,9 @@ class GeminiAgent:
         name = function_call.name
         args = function_call.args
 
-        logger.debug(f"function_call: {name}({args})")
+        logger.debug("function_call: {}({})", name, args)
         function_result = await self.mcp_handler.call_tool(name, args=args)
-        logger.debug(f"Tool result: {function_result['content']}")
+        logger.debug("Tool result: {}", function_result["content"])
 
         new_request_body = [
             types.Content(
@@ -18,9 +18,7 @@ class LocalModel(StrEnum):
 class LocalAgent:
     def __init__(self, model: LocalModel):
         self.model = model
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
         self.streamable = True
 
         self.client = pipeline(
@@ -117,7 +117,7 @@ class McpHandler:
 
         response = []
         for match in matches:
-            logger.debug(f"Match: {match}")
+            logger.debug("Match: {}", match)
             if prompt_name := self._prompt_handler.get_prompt_name_from_command(match):
                 prompt = await self.get_prompt(prompt_name)
                 response += prompt
@@ -170,7 +170,7 @@ class _McpPromptHandler:
             self._command_prompt_map[
                 self.config[server_name]["prompt_call"][prompt.name]
             ] = prefixed_prompt.name
-            logger.debug(f"map: {self._command_prompt_map}")
+            logger.debug("map: {}", self._command_prompt_map)
 
     async def get_prompt(
         self, session: ClientSession, name: str, args: dict[str, Any] | None = None
@@ -201,7 +201,7 @@ class _McpResourceHandler:
                 mimeType=resource.mimeType,
             )
             self._resources.append(prefixed_resource)
-            logger.debug(f"Resource: {prefixed_resource.name}")
+            logger.debug("Resource: {}", prefixed_resource.name)
 
     async def read_resource(
         self, session: ClientSession, name: str
@@ -23,9 +23,7 @@ class MLXModel(StrEnum):
 class MLXAgent:
     def __init__(self, model: MLXModel, mcp_handler: McpHandler):
         self.model = model
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
         self.max_tokens = 4096
         self.streamable = True
 
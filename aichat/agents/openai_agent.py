@@ -1,4 +1,5 @@
 from enum import StrEnum
+from functools import cache
 import json
 import os
 
@@ -28,17 +29,25 @@ class OpenAIModel(StrEnum):
     GPT41NANO = "gpt-4.1-nano"
 
 
+# モデルを切り替えるたびにAgentが作られるので, HTTP接続を持つclientは共有する
+@cache
+def _get_client() -> AsyncOpenAI:
+    return AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+
 class OpenAIAgent:
     def __init__(self, model: OpenAIModel, mcp_handler: McpHandler):
         self.model = model
-        self.role = Role(
-            f"{config.AGENT_NAME} ({self.model})", config.AGENT_AVATAR_COLOR
-        )
+        self.role = Role.intern(f"{config.AGENT_NAME} ({self.model})")
         self.streamable = True
-        self.client = AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+        self.client = _get_client()
         self.mcp_handler = mcp_handler
 
     def _construct_request(self, message: Message) -> dict[str, Any]:
+        # 会話履歴は毎回まとめて送るので, 変換済みのリクエストをメッセージに持たせて使い回す
+        return message.cached_request("openai", self._build_request)
+
+    def _build_request(self, message: Message) -> dict[str, Any]:
         """Constructs the request dictionary for a single message."""
         request: dict[str, Any] = {
             "role": ("assistant" if message.is_assistant_message() else "user")
@@ -212,9 +221,9 @@ class OpenAIAgent:
                 is_final_response = False
 
                 tool_args_dict = json.loads(str(tool_args))
-                logger.debug(f"Tool ID: {tool_id}")
-                logger.debug(f"Tool Name: {tool_name}")
-                logger.debug(f"Tool Args: {tool_args}")
+                logger.debug("Tool ID: {}", tool_id)
+                logger.debug("Tool Name: {}", tool_name)
+                logger.debug("Tool Args: {}", tool_args)
 
                 prompt.extend(
                     await self._process_function_call(
@@ -250,10 +259,10 @@ class OpenAIAgent:
                 ],
             }
         )
-        logger.debug(f"function_call: {name}({args})")
+        logger.debug("function_call: {}({})", name, args)
         try:
             function_result = await self.mcp_handler.call_tool(name, args=args)
-            logger.debug(f"Tool result: {function_result['content']}")
+            logger.debug("Tool result: {}", function_result["content"])
             new_request_body.append(
                 {
                     "role": "tool",
@@ -3,10 +3,16 @@ import flet as ft
 
 IS_DEBUG = True
 USE_MISTRAL_OCR = True  # Requires Mistral API key
+INCLUDE_OCR_IMAGES = False  # Attach images extracted by Mistral OCR to the chat
 
 # Database
 DB_NAME = "aichat.db"
 DEBUG_DB_NAME = "aichat_dbg.db"
+# Image files referenced from the database
+BLOB_DIR = "blobs"
+DEBUG_BLOB_DIR = "blobs_dbg"
+# Parsed PDF contents keyed by the file hash
+OCR_CACHE_DIR = "ocr_cache"
 
 USER_NAME = "User"
 USER_AVATAR_COLOR = ft.Colors.GREEN
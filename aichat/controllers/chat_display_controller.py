@@ -1,13 +1,21 @@
-from typing import Callable
+from collections import OrderedDict
+from itertools import islice
+from typing import Callable, Iterator
 
 import flet as ft
 from loguru import logger
 
+import config
 from topics import Topics
 from models.message import Message
 
 
 class ChatDisplayController:
+    # 過去チャットを開くときに一度に描画するメッセージ数
+    RESTORE_BATCH_SIZE = 50
+    # キャッシュしておくRowの数. 超えたら最近使っていないものから捨てる
+    ROW_CACHE_SIZE = 1000
+
     def __init__(
         self,
         page: ft.Page,
@@ -18,36 +26,118 @@ class ChatDisplayController:
         self.update_content_callback = update_content_callback
         self.item_builder = item_builder
 
+        # 過去チャットを開き直したときにRowを作り直さないためのキャッシュ
+        self._row_cache: OrderedDict[str, ft.Row] = OrderedDict()
+        # ストリーミングで更新中のRow. 応答が終わったら次の追加時にリセットする
+        self._streaming_row: ft.Row | None = None
+        # 表示中のチャット. 同じチャットを開き直したときは読み込みを省く
+        self._displayed_chat_id: str | None = None
+        # まだRowを作っていないメッセージ. スクロールに合わせて取り出して描画する
+        self._pending_messages: Iterator[Message] = iter(())
+        # 画面に出ている行のうちAgentに送るメッセージ. 行の追加に合わせて更新する
+        self._agent_messages: list[Message] = []
+
     def restore_past_chat(self, chat_id: str):
-        messages = self._get_all_messages_by_chat_id(chat_id)
-        self.page.run_task(
-            self.update_content_callback,
-            [self.item_builder(self.page, m) for m in messages],
+        if chat_id == self._displayed_chat_id:
+            logger.debug("chat_id={} is already displayed", chat_id)
+            return
+
+        self._displayed_chat_id = chat_id
+        self._streaming_row = None
+        self._pending_messages = self._get_all_messages_by_chat_id(chat_id)
+
+        # 最初の画面分だけRowを作り, 残りはスクロールされたときに作る
+        batch = islice(self._pending_messages, self.RESTORE_BATCH_SIZE)
+        rows = [self._get_row(m) for m in batch]
+        self._agent_messages = []
+        self._track_agent_messages(rows)
+        self.page.run_task(self.update_content_callback, rows)
+
+    def load_more_rows(self, controls: list[ft.Row]) -> bool:
+        """未描画のメッセージを次の分だけ追加する. 追加するものがなければFalse"""
+        batch = list(islice(self._pending_messages, self.RESTORE_BATCH_SIZE))
+        if not batch:
+            return False
+
+        rows = [self._get_row(m) for m in batch]
+        controls.extend(rows)
+        self._track_agent_messages(rows)
+        self.page.run_task(self.update_content_callback, controls)
+
+        return True
+
+    def _get_row(self, message: Message) -> ft.Row:
+        row = self._row_cache.get(message.id)
+        if row is not None:
+            self._row_cache.move_to_end(message.id)
+            return row
+
+        row = self.item_builder(self.page, message)
+        self._row_cache[message.id] = row
+        if len(self._row_cache) > self.ROW_CACHE_SIZE:
+            self._row_cache.popitem(last=False)
+        return row
+
+    def _track_agent_messages(self, rows: list[ft.Row]):
+        """末尾に追加した行のうち, Agentに送るもののメッセージを控えておく"""
+        self._agent_messages.extend(
+            row.message  # type: ignore
+            for row in rows
+            if not row.exclude_from_agent_request  # type: ignore
         )
 
     def clear_controls(self):
+        self._displayed_chat_id = None
+        self._pending_messages = iter(())
+        self._agent_messages = []
+        self._streaming_row = None
         self.page.run_task(self.update_content_callback, [])
 
     def add_new_message(self, controls: list[ft.Row], message: Message | list[Message]):
+        self._streaming_row = None
         message = message if isinstance(message, list) else [message]
-        new_controls = controls + [self.item_builder(self.page, m) for m in message]
-        self.page.run_task(self.update_content_callback, new_controls)
+        self._displayed_chat_id = message[-1].chat_id
+        # 新しいメッセージは末尾に付くので, 未描画の履歴を先に全て追加する
+        rows = [self._get_row(m) for m in self._pending_messages]
+        self._pending_messages = iter(())
+        # 既存の行は作り直さず, 追加分だけを足す
+        rows.extend(self.item_builder(self.page, m) for m in message)
+        controls.extend(rows)
+        self._track_agent_messages(rows)
+        self.page.run_task(self.update_content_callback, controls)
 
-        self.page.pubsub.send_all_on_topic(
-            Topics.REQUEST_TO_AGENT, [ctl.message for ctl in new_controls]
-        )
+        # Agentへのリクエストはユーザーの発言に対してのみ行う
+        if message[-1].role.name == config.USER_NAME:
+            # 後から行が追加されても変わらないようにコピーして渡す
+            agent_messages = list(self._agent_messages)
+            self.page.pubsub.send_all_on_topic(Topics.REQUEST_TO_AGENT, agent_messages)
+            logger.debug(
+                "{} published topic: {}",
+                self.__class__.__name__,
+                Topics.REQUEST_TO_AGENT,
+            )
 
         self.page.pubsub.send_all_on_topic(Topics.UPDATE_CHAT, None)
-        logger.debug(
-            f"{self.__class__.__name__} published topic: {Topics.REQUEST_TO_AGENT}"
-        )
 
     def update_message_streamly(self, controls: list[ft.Row], message: Message):
-        if controls[-1].message.role.avatar_color == message.role.avatar_color:  # type: ignore
-            controls[-1] = self.item_builder(self.page, message)
+        row = self._streaming_row
+        if row is not None and row.message.role.avatar_color == message.role.avatar_color:  # type: ignore
+            row.update_message(message)  # type: ignore
+            # ストリーミング中の行は常に末尾にある
+            if not row.exclude_from_agent_request:  # type: ignore
+                self._agent_messages[-1] = message
+            # 変わったのはこの行だけなので, リスト全体ではなく行だけを送る
+            self.page.run_task(self._update_control, row)
         else:
-            controls.append(self.item_builder(self.page, message))
-        self.page.run_task(self.update_content_callback, controls)
+            row = self.item_builder(self.page, message)
+            controls.append(row)
+            self._track_agent_messages([row])
+            self._streaming_row = row
+            self.page.run_task(self.update_content_callback, controls)
+
+    @staticmethod
+    async def _update_control(control: ft.Control):
+        control.update()
 
-    def _get_all_messages_by_chat_id(self, chat_id: int) -> list[Message]:
+    def _get_all_messages_by_chat_id(self, chat_id: int) -> Iterator[Message]:
         return Message.get_all_by_chat_id(chat_id)
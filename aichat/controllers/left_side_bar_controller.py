@@ -7,6 +7,9 @@ from models.chat import Chat
 
 
 class PastChatListController:
+    # 一度に読み込むチャット数. 残りはスクロールに合わせて読み込む
+    PAGE_SIZE = 30
+
     def __init__(
         self,
         update_view_callback: Callable[[list[ft.ListTile]], None],
@@ -15,14 +18,55 @@ class PastChatListController:
         self.update_view_callback = update_view_callback
         self.item_builder = item_builder
 
+        self._loaded_count = 0
+        self._has_more = True
+        # チャットごとの項目. 一覧を作り直すときに既存の項目を使い回す
+        self._item_cache: dict[str, ft.ListTile] = {}
+        self._items: list[ft.ListTile] = []
+
     def update_chat_list(self, page: ft.Page):
-        chats = self.collect_all_chat()
-        controls = [self.item_builder(page, c.id, c.title) for c in chats]
+        # 読み込み済みの件数は保ったまま作り直す (スクロール位置が戻らないように)
+        old_items = self._items
+        items = self.build_chat_items(page, max(self._loaded_count, self.PAGE_SIZE))
+        # チャットが増えていなければ同じ項目が並ぶので, 画面は更新しない
+        if items != old_items:
+            self.update_view_callback(items)
+
+    def build_chat_items(
+        self, page: ft.Page, limit: int = PAGE_SIZE
+    ) -> list[ft.ListTile]:
+        chats = self.collect_chats(limit, 0)
+        self._loaded_count = len(chats)
+        self._has_more = len(chats) == limit
+
+        self._items = self._get_items(page, chats)
+        # 一覧から外れたチャットの項目は捨てる
+        self._item_cache = {c.id: item for c, item in zip(chats, self._items)}
+
+        return list(self._items)
+
+    def load_more_chat_items(self, page: ft.Page) -> list[ft.ListTile]:
+        """次のページのチャットを返す. 全て読み込み済みなら空のリスト"""
+        if not self._has_more:
+            return []
+
+        chats = self.collect_chats(self.PAGE_SIZE, self._loaded_count)
+        self._loaded_count += len(chats)
+        self._has_more = len(chats) == self.PAGE_SIZE
+
+        items = self._get_items(page, chats)
+        self._items.extend(items)
+
+        return items
 
-        self.update_view_callback(controls)
+    def _get_items(self, page: ft.Page, chats: list[Chat]) -> list[ft.ListTile]:
+        items = []
+        for chat in chats:
+            if chat.id not in self._item_cache:
+                self._item_cache[chat.id] = self.item_builder(page, chat)
+            items.append(self._item_cache[chat.id])
 
-    def collect_all_chat(self) -> list[Chat]:
-        chats = Chat.get_all()
-        chats.sort(key=lambda x: x.created_at, reverse=True)
+        return items
 
-        return chats
+    def collect_chats(self, limit: int, offset: int) -> list[Chat]:
+        return Chat.get_page(limit, offset)
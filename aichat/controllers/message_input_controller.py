@@ -1,19 +1,119 @@
+import asyncio
 import base64
+from functools import cache
+import hashlib
+import json
+import mmap
 import os
 from pathlib import Path
-from typing import Callable
+import tempfile
+from typing import TYPE_CHECKING, Awaitable, Callable
 
+from charset_normalizer import from_bytes
 import flet as ft
 from flet.core.file_picker import FilePickerFile
 from loguru import logger
-from mistralai import Mistral, models
-import pdfplumber
 
 import config
 from models.message import Message, ContentType
 from models.role import Role
 from topics import Topics
 
+# mistralaiとpypdfium2は重いので, PDFを読み込むときに初めてimportする
+if TYPE_CHECKING:
+    from mistralai import Mistral, models
+    import pypdfium2 as pdfium
+
+
+_MISTRAL_API_KEY = os.environ.get("MISTRAL_API_KEY")
+_USE_MISTRAL_OCR = config.USE_MISTRAL_OCR and bool(_MISTRAL_API_KEY)
+
+
+@cache
+def _get_mistral_client() -> "Mistral":
+    from mistralai import Mistral
+    from mistralai.utils import BackoffStrategy, RetryConfig
+
+    # 429/5xx (OCRの503など) は指数バックオフで再試行する. 単位はms
+    retry_config = RetryConfig(
+        "backoff",
+        BackoffStrategy(
+            initial_interval=1000,
+            max_interval=30000,
+            exponent=2.0,
+            max_elapsed_time=120000,
+        ),
+        retry_connection_errors=True,
+    )
+
+    return Mistral(api_key=_MISTRAL_API_KEY, retry_config=retry_config)
+
+
+def _split_data_url(data_url: str) -> tuple[str, ContentType]:
+    """"data:image/png;base64,..." をbase64部分と画像の種類に分ける"""
+    header, sep, payload = data_url.partition(",")
+    if not sep:  # ヘッダーなしの生のbase64
+        return data_url, ContentType.JPEG
+
+    if header.startswith("data:image/png"):
+        return payload, ContentType.PNG
+    return payload, ContentType.JPEG
+
+
+# ファイル先頭のマジックナンバーと, それに対応する拡張子
+_MAGIC_NUMBERS = [
+    (b"%PDF-", ".pdf"),
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+]
+
+
+def _sniff_suffix(file_path: Path) -> str | None:
+    with open(file_path, "rb") as f:
+        head = f.read(8)
+
+    for magic, suffix in _MAGIC_NUMBERS:
+        if head.startswith(magic):
+            return suffix
+    return None
+
+
+# UTF-8以外でよく使われる文字コード. 似た文字コード (cp1257など) と取り違えないよう先に試す
+_TEXT_ENCODINGS = ["cp932", "euc_jp", "iso2022_jp", "cp1252", "utf_16", "utf_32"]
+
+
+def _file_digest(file_path: Path) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def _read_pdf_cache(cache_path: Path) -> list[tuple[str, str, ContentType]] | None:
+    try:
+        cached = json.loads(cache_path.read_text(encoding="utf-8"))
+        return [(d, s, ContentType(t)) for d, s, t in cached]
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        # 書きかけなどで壊れたキャッシュは消して, 読み込み直す
+        logger.warning(f"Broken PDF cache removed: {cache_path}")
+        cache_path.unlink(missing_ok=True)
+        return None
+
+
+def _write_pdf_cache(cache_path: Path, contents: list[tuple[str, str, ContentType]]):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    # 同じPDFを同時に読み込んでも書きかけを読まないよう, 一時ファイルから置き換える
+    fd, tmp_path = tempfile.mkstemp(
+        dir=cache_path.parent, prefix=f".{cache_path.name}."
+    )
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(contents, f)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 
 class MessageInputController:
     """
@@ -27,20 +127,21 @@ class MessageInputController:
         page: ft.Page,
         update_view_callback: Callable[[], None],
     ):
-        self.role = Role(config.USER_NAME, config.USER_AVATAR_COLOR)
+        self.role = Role.intern(config.USER_NAME)
         self.pubsub = page.pubsub
         self.update_view_callback = update_view_callback
 
-    def send_message(self, chat_id: str, text: str):
-        # User messageの追加
-        msg = Message.construct_auto(chat_id, text, self.role)
-        msg.insert_into_db()
+    def send_message(self, chat_id: str, text: str | list[str]):
+        # User messageの追加. 複数の場合もまとめて1回で保存・通知する
+        texts = text if isinstance(text, list) else [text]
+        messages = [Message.construct_auto(chat_id, t, self.role) for t in texts]
+        Message.bulk_insert(messages)
 
         self.update_view_callback()
         logger.debug(
-            f"{self.__class__.__name__} published topic: {Topics.APPEND_MESSAGE}"
+            "{} published topic: {}", self.__class__.__name__, Topics.APPEND_MESSAGE
         )
-        self.pubsub.send_all_on_topic(Topics.APPEND_MESSAGE, msg)
+        self.pubsub.send_all_on_topic(Topics.APPEND_MESSAGE, messages)
 
 
 class FileLoaderController:
@@ -50,158 +151,249 @@ class FileLoaderController:
         self.pubsub = pubsub
         self.update_view_callback = update_view_callback
 
-    def append_files(self, e: ft.FilePickerResultEvent, chat_id: str):
-        if e.files is None:
+        # 拡張子ごとのファイル読み込み処理. 該当なしはテキストとして読む
+        self._file_handlers: dict[
+            str, Callable[[Path, str], Awaitable[list[Message]]]
+        ] = {
+            ".png": self._load_png,
+            ".jpg": self._load_jpeg,
+            ".jpeg": self._load_jpeg,
+            ".pdf": self._load_pdf,
+        }
+
+    async def append_files(self, e: ft.FilePickerResultEvent, chat_id: str):
+        if not e.files:
             logger.error("No files selected")
             return
 
-        for f in e.files:  # type: ignore
-            self.append_file_content_to_chatlist(chat_id, f)
-
-    def append_file_content_to_chatlist(self, chat_id: str, file: FilePickerFile):
-        file_path = Path(file.path)
+        # 全ファイルを読み込んでから, 保存・通知・画面更新を1回ずつ行う
+        # 読み込めないファイルがあっても, 他のファイルは追加する
+        loaded = await asyncio.gather(
+            *(self._load_file(chat_id, f) for f in e.files),  # type: ignore
+            return_exceptions=True,
+        )
         messages: list[Message] = []
-        match file_path.suffix.lstrip(".").lower():
-            case "png":
-                msg = self._image_to_message(
-                    chat_id=chat_id,
-                    file_path=file_path,
-                    content_type=ContentType.PNG,
-                )
-                msg.insert_into_db()
-                messages.append(msg)
-            case "jpg" | "jpeg":
-                msg = self._image_to_message(
-                    chat_id=chat_id,
-                    file_path=file_path,
-                    content_type=ContentType.JPEG,
-                )
-                msg.insert_into_db()
-                messages.append(msg)
-            case "pdf":
-                messages.extend(self._parse_pdf(file.path, chat_id))
-                for m in messages:
-                    m.insert_into_db()
-            case _:
-                try:
-                    with open(file.path, "r") as f:
-                        content = f.read()
-
-                    msg = Message.construct_auto_file(
-                        chat_id=chat_id,
-                        display_content=f"File Uploaded: {file_path.name}",
-                        system_content=content,
-                        content_type=ContentType.TEXT,
-                        role=Role(config.APP_ROLE_NAME, config.APP_ROLE_AVATAR_COLOR),
-                    )
-                    msg.insert_into_db()
-                    messages.append(msg)
-                except UnicodeDecodeError:
-                    logger.error(f"Unsupported file type: {file.path}")
-                    raise ValueError(f"Unsupported file type: {file.path}")
+        for file, result in zip(e.files, loaded):
+            if isinstance(result, BaseException):
+                logger.opt(exception=result).error(f"Failed to load file: {file.path}")
+                continue
+            messages.extend(result)
+
+        if not messages:
+            return
+        Message.bulk_insert(messages)
 
         topic = Topics.APPEND_MESSAGE
         self.pubsub.send_all_on_topic(topic, messages)
-        logger.debug(f"{self.__class__.__name__} published topic: {topic}")
+        logger.debug("{} published topic: {}", self.__class__.__name__, topic)
 
         self.update_view_callback()
 
-    def _image_to_message(
+    async def _load_file(self, chat_id: str, file: FilePickerFile) -> list[Message]:
+        file_path = Path(file.path)
+        handler = self._file_handlers.get(file_path.suffix.lower())
+        if handler is None:
+            # 拡張子で判別できないときはファイルの先頭で判別する
+            handler = self._file_handlers.get(_sniff_suffix(file_path), self._load_text)
+
+        return await handler(file_path, chat_id)
+
+    async def _load_png(self, file_path: Path, chat_id: str) -> list[Message]:
+        return [await self._load_image(chat_id, file_path, ContentType.PNG)]
+
+    async def _load_jpeg(self, file_path: Path, chat_id: str) -> list[Message]:
+        return [await self._load_image(chat_id, file_path, ContentType.JPEG)]
+
+    async def _load_pdf(self, file_path: Path, chat_id: str) -> list[Message]:
+        return await self._parse_pdf(file_path, chat_id)
+
+    async def _load_text(self, file_path: Path, chat_id: str) -> list[Message]:
+        raw = file_path.read_bytes()
+
+        try:
+            content = raw.decode("utf-8-sig")
+        except UnicodeDecodeError:
+            # UTF-8でなければ文字コードを推定する (CP932なども読めるように)
+            # 短いUTF-8は推定を誤りやすいので, 推定はここでだけ行う
+            match = (
+                from_bytes(raw, cp_isolation=_TEXT_ENCODINGS).best()
+                or from_bytes(raw).best()
+            )
+            if match is None:
+                logger.error(f"Unsupported file type: {file_path}")
+                raise ValueError(f"Unsupported file type: {file_path}")
+            content = raw.decode(match.encoding)
+
+        msg = Message.construct_auto_file(
+            chat_id=chat_id,
+            display_content=f"File Uploaded: {file_path.name}",
+            system_content=content,
+            content_type=ContentType.TEXT,
+            role=Role.intern(config.APP_ROLE_NAME),
+        )
+
+        return [msg]
+
+    async def _load_image(
         self, chat_id: str, file_path: Path, content_type: ContentType
     ) -> Message:
-        with open(file_path, "rb") as f:
-            content = base64.b64encode(f.read()).decode("utf-8")
+        # 大きな画像のbase64エンコードでUIが止まらないようにスレッドで実行する
+        return await asyncio.to_thread(
+            self._image_to_message, chat_id, file_path, content_type
+        )
 
+    def _image_to_message(
+        self, chat_id: str, file_path: Path, content_type: ContentType
+    ) -> Message:
         msg = Message.construct_auto_file(
             chat_id=chat_id,
             display_content=f"File Uploaded: {file_path.name}",
-            system_content=content,
+            system_content="",
             content_type=content_type,
-            role=Role(config.APP_ROLE_NAME, config.APP_ROLE_AVATAR_COLOR),
+            role=Role.intern(config.APP_ROLE_NAME),
         )
 
+        # mmapしたファイルを直接エンコード・保存し, 読み込み用のコピーを作らない
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:  # 空ファイルはmmapできない
+                msg.store_blob(b"")
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    msg.system_content = base64.b64encode(mm).decode("ascii")
+                    msg.store_blob(mm)
+
         return msg
 
-    def _parse_pdf(self, file_path: str, chat_id: str) -> list[Message]:
-        text = ""
-        if config.USE_MISTRAL_OCR and os.environ.get("MISTRAL_API_KEY"):
-            client = Mistral(api_key=os.environ.get("MISTRAL_API_KEY"))
-            signed_url = self._upload_file_to_mistral_dataset(client, file_path)
-            ocr_response = self._get_ocr_response(client, signed_url)
-
-            for idx, p in enumerate(ocr_response.pages):
-                if idx == 0:
-                    logger.debug(p.markdown)
-                text += p.markdown + " "
-
-            messages = [
-                Message.construct_auto_file(
-                    chat_id,
-                    display_content=f"File Uploaded: {file_path.rsplit('/', 1)[-1]}",
-                    system_content=text,
-                    content_type=ContentType.TEXT,
-                    role=Role(config.APP_ROLE_NAME, config.APP_ROLE_AVATAR_COLOR),
-                )
-            ]
-            for page in ocr_response.pages:
-                if len(page.images) == 0:
-                    continue
-
-                for img in page.images:
-                    messages.append(
-                        Message.construct_auto_file(
-                            chat_id,
-                            display_content=f"Image: {img.id}",
-                            system_content=img.image_base64.replace(
-                                "data:image/jpeg;base64,", ""
-                            ),
-                            content_type=ContentType.JPEG,
-                            role=Role(
-                                config.APP_ROLE_NAME, config.APP_ROLE_AVATAR_COLOR
-                            ),
-                        )
-                    )
+    async def _parse_pdf(self, file_path: Path, chat_id: str) -> list[Message]:
+        if _USE_MISTRAL_OCR:
+            suffix = "-images" if config.INCLUDE_OCR_IMAGES else ""
+            contents = await self._load_pdf_contents(file_path, suffix, self._ocr_pdf)
         else:
-            logger.info("Using pdfplumber to parse PDF")
-            with pdfplumber.open(file_path) as pdf:
-                for page in pdf.pages:
-                    text += page.extract_text()
-
-            messages = [
-                Message.construct_auto_file(
-                    chat_id,
-                    display_content=f"File Uploaded: {Path(file_path).name}",
-                    system_content=text,
-                    content_type=ContentType.TEXT,
-                    role=Role("App", ft.Colors.GREY),
-                )
-            ]
+            # v2: ページごとに改行で区切る. 以前の結合方法のキャッシュは使わない
+            contents = await self._load_pdf_contents(
+                file_path, "-pdfium-v2", self._extract_pdf_contents
+            )
+
+        messages = [
+            Message.construct_auto_file(
+                chat_id,
+                display_content=display_content,
+                system_content=system_content,
+                content_type=content_type,
+                role=Role.intern(config.APP_ROLE_NAME),
+            )
+            for display_content, system_content, content_type in contents
+        ]
+
+        # OCRで得た画像はデコードして保存するので, イベントループの外で済ませる
+        images = [m for m in messages if m.is_image()]
+        if images:
+            await asyncio.to_thread(lambda: [m.store_blob() for m in images])
 
         return messages
 
-    def _upload_file_to_mistral_dataset(self, client: Mistral, file_path: str) -> str:
+    async def _load_pdf_contents(
+        self,
+        file_path: Path,
+        cache_suffix: str,
+        parser: Callable[[Path], Awaitable[list[tuple[str, str, ContentType]]]],
+    ) -> list[tuple[str, str, ContentType]]:
+        """
+        PDFの内容を (display_content, system_content, content_type) で返す
+
+        同じ内容のPDFはファイルのハッシュをキーにしたキャッシュから返す
+        """
+        digest = await asyncio.to_thread(_file_digest, file_path)
+        cache_path = Path(config.OCR_CACHE_DIR) / f"{digest}{cache_suffix}.json"
+        if (cached := _read_pdf_cache(cache_path)) is not None:
+            logger.info(f"PDF cache hit: {file_path}")
+            return cached
+
+        contents = await parser(file_path)
+        _write_pdf_cache(cache_path, contents)
+
+        return contents
+
+    async def _ocr_pdf(self, file_path: Path) -> list[tuple[str, str, ContentType]]:
+        client = _get_mistral_client()
+        signed_url = await self._upload_file_to_mistral_dataset(client, file_path)
+        ocr_response = await self._get_ocr_response(client, signed_url)
+
+        if ocr_response.pages:
+            logger.debug(ocr_response.pages[0].markdown)
+        text = "".join(p.markdown + " " for p in ocr_response.pages)
+
+        contents = [(f"File Uploaded: {file_path.name}", text, ContentType.TEXT)]
+        for page in ocr_response.pages:
+            if not config.INCLUDE_OCR_IMAGES or len(page.images) == 0:
+                continue
+
+            for img in page.images:
+                payload, content_type = _split_data_url(img.image_base64)
+                contents.append((f"Image: {img.id}", payload, content_type))
+
+        return contents
+
+    async def _extract_pdf_contents(
+        self, file_path: Path
+    ) -> list[tuple[str, str, ContentType]]:
+        logger.info("Using pypdfium2 to parse PDF")
+        # PDFの解析はCPUを占有するのでイベントループの外で実行する
+        text = await asyncio.to_thread(self._extract_pdf_text, file_path)
+
+        return [(f"File Uploaded: {file_path.name}", text, ContentType.TEXT)]
+
+    def _extract_pdf_text(self, file_path: Path) -> str:
+        import pypdfium2 as pdfium
+
+        pdf = pdfium.PdfDocument(file_path)
+        try:
+            return "\n".join(self._extract_page_text(page) for page in pdf)
+        finally:
+            pdf.close()
+
+    @staticmethod
+    def _extract_page_text(page: "pdfium.PdfPage") -> str:
+        # ページとテキストページはGCを待たずにその場で閉じる
+        try:
+            textpage = page.get_textpage()
+            try:
+                return textpage.get_text_bounded()
+            finally:
+                textpage.close()
+        finally:
+            page.close()
+
+    async def _upload_file_to_mistral_dataset(
+        self, client: "Mistral", file_path: Path
+    ) -> str:
         logger.info("Using Mistral OCR to parse PDF")
 
         logger.info(f"Uploading File to Mistral...: {file_path}")
-        uploaded_pdf = client.files.upload(
-            file={
-                "file_name": file_path.split("/")[-1],
-                "content": open(file_path, "rb"),
-            },
-            purpose="ocr",
-        )
+        with open(file_path, "rb") as f:
+            uploaded_pdf = await client.files.upload_async(
+                file={
+                    "file_name": file_path.name,
+                    "content": f,
+                },
+                purpose="ocr",
+            )
+
+        signed_url = await client.files.get_signed_url_async(file_id=uploaded_pdf.id)
 
-        return client.files.get_signed_url(file_id=uploaded_pdf.id)
+        return signed_url.url
 
-    def _get_ocr_response(self, client: Mistral, signed_url: str) -> models.OCRResponse:  # type: ignore
+    async def _get_ocr_response(
+        self, client: "Mistral", signed_url: str
+    ) -> "models.OCRResponse":
         logger.info("Getting OCR response from Mistral...")
-        ocr_response = client.ocr.process(
+        ocr_response = await client.ocr.process_async(
             model="mistral-ocr-latest",
             document={
                 "type": "document_url",
                 "document_url": signed_url,
             },
-            include_image_base64=True,
+            include_image_base64=config.INCLUDE_OCR_IMAGES,
         )
         logger.info("OCR response received!")
 
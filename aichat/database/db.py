@@ -1,6 +1,9 @@
+from contextlib import contextmanager
 from datetime import datetime
+from functools import lru_cache
 import sqlite3
-from typing import Protocol
+import threading
+from typing import Iterator, Protocol
 
 from loguru import logger
 
@@ -17,70 +20,173 @@ def _convert_datetime(text: bytes):
     return datetime.fromisoformat(text.decode())
 
 
+# 変換はプロセス全体で共通なので, SQLiteDBを作るたびではなく一度だけ登録する
+sqlite3.register_adapter(datetime, _adapt_datetime)
+sqlite3.register_converter("DATETIME", _convert_datetime)
+
+
+@lru_cache(maxsize=16)
+def _build_insert_sql(
+    table_name: str, columns: tuple[str, ...], or_ignore: bool = False
+) -> str:
+    return (
+        f"INSERT {'OR IGNORE ' if or_ignore else ''}INTO {table_name}"
+        + f" ({', '.join(columns)})"
+        + f" VALUES ({', '.join(['?' for _ in columns])});"
+    )
+
+
 class DB(Protocol):
     def insert(self, table_name: str, schema: list[Schema], values: list):
         pass
 
 
 class SQLiteDB:
+    # 存在を確認済みの (db_name, table_name). SQLiteDBは呼び出しごとに作られるのでクラスで共有する
+    _known_tables: set[tuple[str, str]] = set()
+    # db_nameごとの接続. 毎回接続し直さずプロセス内で使い回す
+    _connections: dict[str, sqlite3.Connection] = {}
+    _lock = threading.RLock()
+    # トランザクション中のdb_name. 入れ子の呼び出しでは途中でcommitしない
+    _in_transaction: set[str] = set()
+
     def __init__(self, is_debug: bool = False):
         if is_debug:
             self.db_name = config.DEBUG_DB_NAME
         else:
             self.db_name = config.DB_NAME
 
-        sqlite3.register_adapter(datetime, _adapt_datetime)
-        sqlite3.register_converter("DATETIME", _convert_datetime)
+    @contextmanager
+    def __get_connection(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            conn = self._connections.get(self.db_name)
+            if conn is None:
+                conn = self._connect()
+                self._connections[self.db_name] = conn
 
-    def __get_connection(self):
-        return sqlite3.connect(self.db_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            if self.db_name in self._in_transaction:
+                yield conn
+                return
 
-    def insert(self, table_name: str, schema: list[Schema], values: list):
-        if not self._table_exist(table_name):
-            logger.debug(f"{table_name} table does not exist. Create table...")
-            self._create_table(table_name, schema)
-
-        columns = [s.column_name for s in schema]
-        sql = (
-            f"INSERT INTO {table_name} ({', '.join(columns)})"
-            + f" VALUES ({', '.join(['?' for _ in schema])});"
+            # with conn: で成功時にcommit, 例外時にrollbackされる
+            self._in_transaction.add(self.db_name)
+            try:
+                with conn:
+                    yield conn
+            finally:
+                self._in_transaction.discard(self.db_name)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """この中での書き込みを1つのトランザクションにまとめる"""
+        with self.__get_connection():
+            yield
+
+    def _connect(self) -> sqlite3.Connection:
+        logger.info(f"Connecting to {self.db_name}...")
+        conn = sqlite3.connect(
+            self.db_name,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.execute("PRAGMA temp_store=MEMORY;")
+        conn.execute("PRAGMA cache_size=-20000;")  # 約20MBのページキャッシュ
+
+        return conn
+
+    def insert(
+        self,
+        table_name: str,
+        schema: list[Schema],
+        values: list,
+        indexes: list[list[str]] | None = None,
+    ):
+        self.insert_many(table_name, schema, [values], indexes)
+
+    def insert_many(
+        self,
+        table_name: str,
+        schema: list[Schema],
+        rows: list[list],
+        indexes: list[list[str]] | None = None,
+        or_ignore: bool = False,
+    ) -> int:
+        """rowsを1トランザクションでまとめてINSERTし, 追加した行数を返す
+
+        or_ignoreがTrueなら主キーが既にある行は飛ばす
+        """
+        self.prepare_table(table_name, schema, indexes)
+
+        sql = _build_insert_sql(
+            table_name, tuple(s.column_name for s in schema), or_ignore
         )
         with self.__get_connection() as conn:
-            conn.execute(sql, values)
-
-    def entry_exist(self, table_name: str, condition: str) -> bool:
-        sql = f"SELECT * FROM {table_name} WHERE {condition};"
-        with self.__get_connection() as conn:
-            try:
-                res = conn.execute(sql)
-            except sqlite3.OperationalError:
-                """e.g. Table does not exist"""
-                return False
-
-            if res.fetchone():
-                return True
-        return False
-
-    def get_all(self, table_name: str, condition: str | None = None) -> list[tuple]:
-        sql = f"SELECT * FROM {table_name};"
+            return conn.executemany(sql, rows).rowcount
+
+    def get_all(
+        self,
+        table_name: str,
+        condition: str | None = None,
+        order_by: str | None = None,
+        limit: int | None = None,
+        offset: int = 0,
+        params: tuple = (),
+    ) -> list[tuple]:
+        """paramsはconditionの "?" に渡す値. SQLに値を埋め込まず文をキャッシュさせる"""
+        sql = f"SELECT * FROM {table_name}"
         if condition:
-            sql = sql[:-1] + f" WHERE {condition};"
+            sql += f" WHERE {condition}"
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        if limit is not None:
+            sql += " LIMIT ? OFFSET ?"
+            params = (*params, limit, offset)
+        sql += ";"
         with self.__get_connection() as conn:
             try:
-                return conn.execute(sql).fetchall()
+                return conn.execute(sql, params).fetchall()
             except sqlite3.OperationalError:
                 """e.g. Table does not exist"""
                 return []
 
-    def _table_exist(self, table_name: str) -> bool:
-        sql = "SELECT name FROM sqlite_master WHERE type='table' AND name=?"
-        with self.__get_connection() as conn:
-            if conn.execute(sql, (table_name,)).fetchone():
-                return True
-        return False
-
-    def _create_table(self, table_name: str, schema: list[Schema]):
-        logger.info(f"Create {table_name} table...")
+    def prepare_table(
+        self,
+        table_name: str,
+        schema: list[Schema],
+        indexes: list[list[str]] | None = None,
+    ):
+        """テーブルがなければ作成する. transaction() の中で書き込むテーブルは先にこれで用意する"""
+        if (self.db_name, table_name) not in self._known_tables:
+            self._prepare_table(table_name, schema, indexes or [])
+
+    def _prepare_table(
+        self, table_name: str, schema: list[Schema], indexes: list[list[str]]
+    ):
+        """テーブルがなければ作成し, indexを揃える. プロセス内でテーブルごとに1回だけ呼ぶ"""
+        # 既存のDBにも後から追加したindexを作る. DDLはまとめて1回で実行する
+        script = "\n".join(
+            [
+                "BEGIN;",
+                self._create_table_sql(table_name, schema),
+                *[self._create_index_sql(table_name, columns) for columns in indexes],
+                "COMMIT;",
+            ]
+        )
+        logger.debug("Execute SQL: {}", script)
+        with self._lock:
+            # executescriptは実行前に開いているトランザクションをcommitしてしまう
+            if self.db_name in self._in_transaction:
+                raise RuntimeError(
+                    f"Table {table_name} must be prepared outside of a transaction"
+                )
+            with self.__get_connection() as conn:
+                conn.executescript(script)
+
+        self._known_tables.add((self.db_name, table_name))
+
+    def _create_table_sql(self, table_name: str, schema: list[Schema]) -> str:
         schema_declaration = ", ".join(
             [
                 f"{s.column_name} {s.column_type} "
@@ -90,8 +196,11 @@ class SQLiteDB:
             ]
         )
 
-        sql = f"CREATE TABLE {table_name} ({schema_declaration});"
-        logger.debug(f"Execute SQL: {sql}")
-        with self.__get_connection() as conn:
-            logger.debug(f"Execute SQL: {sql}")
-            conn.execute(sql, ())
+        return f"CREATE TABLE IF NOT EXISTS {table_name} ({schema_declaration});"
+
+    def _create_index_sql(self, table_name: str, columns: list[str]) -> str:
+        index_name = f"idx_{table_name}_{'_'.join(columns)}"
+        return (
+            f"CREATE INDEX IF NOT EXISTS {index_name}"
+            + f" ON {table_name} ({', '.join(columns)});"
+        )
@@ -1,4 +1,4 @@
-import uuid
+import secrets
 
 import flet as ft
 
@@ -22,7 +22,7 @@ def main(page: ft.Page):
     _ = AgentController(page=page)
 
     # Session Variables
-    page.session.set("chat_id", str(uuid.uuid4()))
+    page.session.set("chat_id", secrets.token_hex(16))
     page.session.set("agent", agent)
 
     # Widgets
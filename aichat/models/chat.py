@@ -1,54 +1,69 @@
+from dataclasses import dataclass
 from datetime import datetime
-from typing import Self
+from functools import lru_cache
+from typing import ClassVar, Self
 
 import config
 from database.db import SQLiteDB
 from models.model import Schema
 
-from pydantic.dataclasses import dataclass
 
-
-@dataclass
+@dataclass(slots=True)
 class Chat:
     id: str
     created_at: datetime
     title: str
 
+    # インスタンスごとに変わらないので, insertのたびに作らずクラスで共有する
+    schema: ClassVar[list[Schema]] = [
+        Schema("id", "text", is_primary_key=True, is_nullable=False),
+        Schema("created_at", "text", is_nullable=False),
+        Schema("title", "text", is_nullable=False),
+    ]
+    table_name: ClassVar[str] = "chat"
+    indexes: ClassVar[list[list[str]]] = [["created_at"]]
+
     @classmethod
     def construct_auto(cls, id: str, title: str):
         return cls(id, datetime.now(), title)
 
     @classmethod
     def from_tuple(cls, t: tuple):
-        return cls(*t)
+        # created_atはTEXTで保存しているのでdatetimeに戻す
+        return cls(t[0], datetime.fromisoformat(t[1]), t[2])
 
-    @property
-    def schema(self) -> list[Schema]:
-        return [
-            Schema("id", "text", is_primary_key=True, is_nullable=False),
-            Schema("created_at", "text", is_nullable=False),
-            Schema("title", "text", is_nullable=False),
-        ]
+    def insert_into_db(self):
+        self.bulk_insert([self])
 
-    @property
-    def table_name(self) -> str:
-        return self.__class__.__name__.lower()
+    @classmethod
+    def bulk_insert(cls, chats: list[Self], ignore_existing: bool = False):
+        """ignore_existingがTrueなら, 既に保存されているidのチャットは飛ばす"""
+        if len(chats) == 0:
+            return
 
-    def insert_into_db(self):
         db = SQLiteDB(config.IS_DEBUG)
-        db.insert(
-            table_name=self.table_name,
-            schema=self.schema,
-            values=[
-                self.id,
-                self.created_at,
-                self.title,
-            ],
+        inserted = db.insert_many(
+            table_name=cls.table_name,
+            schema=cls.schema,
+            rows=[[c.id, c.created_at, c.title] for c in chats],
+            indexes=cls.indexes,
+            or_ignore=ignore_existing,
         )
+        if inserted > 0:
+            cls._fetch_page.cache_clear()
+
+    @classmethod
+    def get_page(cls, limit: int, offset: int = 0) -> list[Self]:
+        """Returns at most `limit` chats, newest first, skipping `offset` chats."""
+        return list(cls._fetch_page(limit, offset))
 
+    # チャット一覧はメッセージのたびに再取得されるので, チャットが追加されるまで使い回す
     @classmethod
-    def get_all(cls) -> list[Self]:
+    @lru_cache(maxsize=32)
+    def _fetch_page(cls, limit: int, offset: int) -> tuple[Self, ...]:
         db = SQLiteDB(config.IS_DEBUG)
-        entities = db.get_all("chat")
+        entities = db.get_all(
+            cls.table_name, order_by="created_at DESC", limit=limit, offset=offset
+        )
 
-        return [cls.from_tuple(e) for e in entities]
+        return tuple(cls.from_tuple(e) for e in entities)
@@ -1,10 +1,17 @@
+import base64
+from collections.abc import Buffer
+from dataclasses import dataclass, field
 from datetime import datetime
 from enum import StrEnum
-import uuid
+import hashlib
+import os
+from pathlib import Path
+import re
+import secrets
+import tempfile
+from typing import Any, Callable, ClassVar, Iterator, Self
 
 from loguru import logger
-from pydantic.dataclasses import dataclass
-
 
 import config
 from database.db import SQLiteDB
@@ -21,7 +28,28 @@ class ContentType(StrEnum):
     UNKNOWN = "unknown"
 
 
-@dataclass
+# DBから読んだ値をEnumの呼び出しを経ずにメンバーへ変換する
+_CONTENT_TYPE_BY_VALUE = {m.value: m for m in ContentType}
+
+# 画像はファイルに保存し, DBには "blob:<sha256>" だけを入れる
+# base64に ":" は含まれないので既存の行と区別できる
+_BLOB_PREFIX = "blob:"
+# テキストの "blob:..." やパスを画像の参照として読まないよう, 形式を厳密に確かめる
+_BLOB_REF_PATTERN = re.compile(r"blob:([0-9a-f]{64})")
+
+
+def _new_id() -> str:
+    """chat_idと同じく32桁の16進数のID. 列はTEXTなので既存のuuid形式と混在できる"""
+    return secrets.token_hex(16)
+
+
+def _blob_dir() -> Path:
+    """画像の保存先. DBファイルと同じ場所に置く (DB_NAMEが相対パスなら起動したディレクトリ基準)"""
+    db_dir = Path(SQLiteDB(config.IS_DEBUG).db_name).resolve().parent
+    return db_dir / (config.DEBUG_BLOB_DIR if config.IS_DEBUG else config.BLOB_DIR)
+
+
+@dataclass(slots=True)
 class Message:
     id: str
     chat_id: str
@@ -30,11 +58,31 @@ class Message:
     system_content: str  # Agentに送信する内容. base64エンコードされた画像データなど
     content_type: ContentType
     role: Role
+    # 保存済みの画像の参照. ワーカースレッドで保存しておけばinsert時に変換しない
+    blob_ref: str | None = field(default=None, compare=False, repr=False)
+    # Agentごとの変換済みリクエストと, 変換したときのsystem_content
+    _requests: dict[str, tuple[str, Any]] | None = field(
+        default=None, init=False, compare=False, repr=False
+    )
+
+    # インスタンスごとに変わらないので, insertのたびに作らずクラスで共有する
+    schema: ClassVar[list[Schema]] = [
+        Schema("id", "text", is_primary_key=True, is_nullable=False),
+        Schema("chat_id", "text", is_nullable=False),
+        Schema("created_at", "text", is_nullable=False),
+        Schema("display_content", "text", is_nullable=True),
+        Schema("system_content", "text", is_nullable=True),
+        Schema("content_type", "text", is_nullable=False),
+        Schema("role", "text", is_nullable=False),
+    ]
+    table_name: ClassVar[str] = "message"
+    # チャットごとのメッセージ取得用
+    indexes: ClassVar[list[list[str]]] = [["chat_id", "created_at"]]
 
     @classmethod
     def construct_auto(cls, chat_id: str, text: str, role: Role):
         return cls(
-            str(uuid.uuid4()),
+            _new_id(),
             chat_id,
             datetime.now(),
             text,
@@ -48,7 +96,7 @@ class Message:
         cls, chat_id: str, display_content: str, system_content: str, role, content_type
     ):
         return cls(
-            str(uuid.uuid4()),
+            _new_id(),
             chat_id,
             datetime.now(),
             display_content,
@@ -59,58 +107,157 @@ class Message:
 
     @classmethod
     def from_tuple(cls, t: tuple):
-        if t[6] == config.USER_NAME:
-            color = config.USER_AVATAR_COLOR
-        elif config.AGENT_NAME in t[6]:
-            color = config.AGENT_AVATAR_COLOR
-        else:
-            color = config.APP_ROLE_AVATAR_COLOR
-        return cls(t[0], t[1], t[2], t[3], t[4], t[5], Role(t[6], color))
-
-    @property
-    def schema(self) -> list[Schema]:
-        return [
-            Schema("id", "text", is_primary_key=True, is_nullable=False),
-            Schema("chat_id", "text", is_nullable=False),
-            Schema("created_at", "text", is_nullable=False),
-            Schema("display_content", "text", is_nullable=True),
-            Schema("system_content", "text", is_nullable=True),
-            Schema("content_type", "text", is_nullable=False),
-            Schema("role", "text", is_nullable=False),
-        ]
+        system_content = t[4]
+        content_type = _CONTENT_TYPE_BY_VALUE[t[5]]
+        match = None
+        if content_type in (ContentType.PNG, ContentType.JPEG) and system_content:
+            match = _BLOB_REF_PATTERN.fullmatch(system_content)
+        if match is not None:
+            try:
+                system_content = cls._read_blob(match.group(1))
+            except FileNotFoundError:
+                # 画像ファイルが消えていても, チャットの残りは復元する
+                logger.warning(f"Image file not found: {system_content}")
+                system_content = f"(Image not found: {t[3]})"
+                content_type = ContentType.TEXT
 
-    @property
-    def table_name(self) -> str:
-        return self.__class__.__name__.lower()
+        # DBの値は型が決まっているので, 変換が必要なものだけ直接変換する
+        return cls(
+            t[0],
+            t[1],
+            datetime.fromisoformat(t[2]),
+            t[3],
+            system_content,
+            content_type,
+            Role.intern(t[6]),
+        )
 
     def insert_into_db(self):
+        self.bulk_insert([self])
+
+    @classmethod
+    def bulk_insert(cls, messages: list[Self]):
+        if len(messages) == 0:
+            return
+
         db = SQLiteDB(config.IS_DEBUG)
-        if not db.entry_exist(table_name="chat", condition=f"id='{self.chat_id}'"):
-            logger.info(f"chat_id={self.chat_id} does not exist. Create chat...")
-            Chat.construct_auto(
-                self.chat_id, self.display_content[:20]
-            ).insert_into_db()
-
-        db.insert(
-            table_name=self.table_name,
-            schema=self.schema,
-            values=[
-                self.id,
-                self.chat_id,
-                self.created_at,
-                self.display_content,
-                self.system_content,
-                self.content_type,
-                self.role.name,
-            ],
-        )
+
+        # チャットの最初のメッセージをタイトルにする
+        first_messages: dict[str, Self] = {}
+        for m in messages:
+            first_messages.setdefault(m.chat_id, m)
+        chats = [
+            Chat.construct_auto(chat_id, m.display_content[:20])
+            for chat_id, m in first_messages.items()
+        ]
+
+        # テーブルの作成はcommitを伴うので, トランザクションを開く前に済ませる
+        db.prepare_table(Chat.table_name, Chat.schema, Chat.indexes)
+        db.prepare_table(cls.table_name, cls.schema, cls.indexes)
+
+        # 画像の保存はDBのロックを取る前に済ませる
+        rows = [
+            [
+                m.id,
+                m.chat_id,
+                m.created_at,
+                m.display_content,
+                m._system_content_for_db(),
+                m.content_type.value,
+                m.role.name,
+            ]
+            for m in messages
+        ]
+
+        # チャットは最初のメッセージと同じトランザクションで保存する
+        # 既存のチャットはINSERT OR IGNOREで飛ばすので, 事前のSELECTは不要
+        with db.transaction():
+            Chat.bulk_insert(chats, ignore_existing=True)
+            db.insert_many(
+                table_name=cls.table_name,
+                schema=cls.schema,
+                indexes=cls.indexes,
+                rows=rows,
+            )
+
+    def cached_request[T](self, key: str, build: Callable[[Self], T]) -> T:
+        """Agent向けに変換したリクエストを返す. 変換結果はメッセージと一緒に捨てられる
+
+        会話履歴は毎回まとめて送るので, 同じkeyの変換はsystem_contentが変わるまで使い回す
+        ストリーミング中の応答は同じメッセージのまま本文が伸びるので, 本文も確かめる
+        """
+        if self._requests is None:
+            self._requests = {}
+
+        cached = self._requests.get(key)
+        if cached is not None and cached[0] == self.system_content:
+            return cached[1]
+
+        request = build(self)
+        self._requests[key] = (self.system_content, request)
+        return request
+
+    def is_image(self) -> bool:
+        return self.content_type in (ContentType.PNG, ContentType.JPEG)
+
+    def store_blob(self, data: Buffer | None = None):
+        """画像をファイルに保存する. 重い処理なのでワーカースレッドから呼ぶ
+
+        dataを渡せばsystem_contentのbase64をデコードせずにそのまま保存する
+        """
+        if data is None:
+            data = base64.b64decode(self.system_content)
+        self.blob_ref = self._write_blob(data)
+
+    def _system_content_for_db(self) -> str:
+        if not self.is_image():
+            return self.system_content
+
+        if self.blob_ref is None:
+            self.store_blob()
+        return self.blob_ref
+
+    @staticmethod
+    def _write_blob(data: Buffer) -> str:
+        """dataをハッシュ名のファイルに保存し, DBに入れる参照を返す"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = _blob_dir() / digest
+        if not path.exists():  # 同じ画像は一度だけ保存する
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 書きかけのファイルが残らないよう, 一時ファイルに書いてから置き換える
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{digest}.")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        return f"{_BLOB_PREFIX}{digest}"
+
+    @staticmethod
+    def _read_blob(digest: str) -> str:
+        data = (_blob_dir() / digest).read_bytes()
+
+        return base64.b64encode(data).decode("ascii")
 
     @classmethod
-    def get_all_by_chat_id(cls, chat_id: int):
+    def get_all_by_chat_id(cls, chat_id: int) -> Iterator[Self]:
+        """chat_idのメッセージを古い順に返す
+
+        画像ファイルの読み込みなどの変換は, 取り出されたメッセージの分だけ行う
+        """
         db = SQLiteDB(config.IS_DEBUG)
-        entities = db.get_all("message", condition=f"chat_id='{chat_id}'")
+        # (chat_id, created_at) のindexでソートせずに読める
+        entities = db.get_all(
+            cls.table_name,
+            condition="chat_id=?",
+            order_by="created_at",
+            params=(chat_id,),
+        )
 
-        return [cls.from_tuple(e) for e in entities]
+        return (cls.from_tuple(e) for e in entities)
 
     def is_assistant_message(self):
         return self.role.avatar_color == config.AGENT_AVATAR_COLOR
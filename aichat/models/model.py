@@ -1,9 +1,8 @@
+from dataclasses import dataclass
 from typing import Protocol
 
-from pydantic.dataclasses import dataclass
 
-
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Schema:
     column_name: str
     column_type: str
@@ -1,8 +1,27 @@
-from pydantic.dataclasses import dataclass
+from dataclasses import dataclass
+from functools import cache
+from typing import Self
+
 import flet as ft
 
+import config
+
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Role:
     name: str
     avatar_color: ft.Colors
+
+    # ロール名ごとにRoleを1つだけ作り, 全メッセージで共有する
+    @classmethod
+    @cache
+    def intern(cls, name: str) -> Self:
+        """nameに対応する共有のRoleを返す. アバターの色は名前から決まる"""
+        if name == config.USER_NAME:
+            color = config.USER_AVATAR_COLOR
+        elif config.AGENT_NAME in name:
+            color = config.AGENT_AVATAR_COLOR
+        else:
+            color = config.APP_ROLE_AVATAR_COLOR
+
+        return cls(name, color)
@@ -1,7 +1,8 @@
-from enum import Enum, auto
+from enum import Enum, IntEnum, auto
 
 
-class Topics(Enum):
+# PubSubのdictのキーになるので, Enumの__hash__より速いintのハッシュを使う
+class Topics(IntEnum):
     UPDATE_CHAT = auto()
     PAST_CHAT_RESTORED = auto()
     NEW_CHAT = auto()
@@ -9,3 +10,7 @@ class Topics(Enum):
     REQUEST_TO_AGENT = auto()
     APPEND_MESSAGE = auto()
     UPDATE_MESSAGE_STREAMLY = auto()
+
+    # ログには数値ではなく名前を出す
+    __str__ = Enum.__str__
+    __format__ = Enum.__format__
@@ -6,23 +6,28 @@ from controllers.chat_display_controller import ChatDisplayController
 from topics import Topics
 
 
+# 全メッセージで同じスタイルを使うので, メッセージごとに作らない
+_MARKDOWN_STYLE_SHEET = ft.MarkdownStyleSheet(
+    blockquote_decoration=ft.BoxDecoration(bgcolor=ft.Colors.GREY)
+)
+
+
 class _ChatMessage(ft.Row):
     def __init__(self, page: ft.Page, message: Message):
         super().__init__()
 
         self.message = message
         self.exclude_from_agent_request = False
+        self._markdown: ft.Markdown | None = None
 
         self.vertical_alignment = ft.CrossAxisAlignment.START
 
         match message.content_type:
             case ContentType.TEXT:
-                content = ft.Markdown(
+                content = self._markdown = ft.Markdown(
                     message.display_content,
                     extension_set=ft.MarkdownExtensionSet.GITHUB_WEB,
-                    md_style_sheet=ft.MarkdownStyleSheet(
-                        blockquote_decoration=ft.BoxDecoration(bgcolor=ft.Colors.GREY)
-                    ),
+                    md_style_sheet=_MARKDOWN_STYLE_SHEET,
                     on_tap_link=lambda e: page.launch_url(e.data),
                 )
             case ContentType.PNG | ContentType.JPEG:
@@ -47,6 +52,12 @@ class _ChatMessage(ft.Row):
             ),
         ]
 
+    def update_message(self, message: Message):
+        """ストリーミング中の本文だけを差し替える"""
+        self.message = message
+        if self._markdown is not None:
+            self._markdown.value = message.display_content
+
 
 class InprogressMessage(ft.Row):
     def __init__(self, message: str):
@@ -70,6 +81,7 @@ class _ChatMessageList(ft.ListView):
         self.spacing = 10
         self.auto_scroll = False
         self.controls: list[_ChatMessage] = []
+        self.on_scroll = self.on_scroll_func
 
         self._item_builder = _ChatMessage
         self.controller = ChatDisplayController(
@@ -89,20 +101,28 @@ class _ChatMessageList(ft.ListView):
         self.controls = controls
         self.update()
 
-    def append_message(self, topic: Topics, message: Message):
-        logger.debug(f"{self.__class__.__name__} received topic: {topic}")
+    # スクロールもPubSubのハンドラーと同じくイベントループ上で処理する
+    async def on_scroll_func(self, e: ft.OnScrollEvent):
+        # 末尾に近づいたら残りの履歴を描画する
+        if e.pixels >= e.max_scroll_extent - 200:
+            self.controller.load_more_rows(self.controls)
+
+    # ハンドラーをasyncにしてページのイベントループ上で順番に実行させる
+    # スレッドプールで並行に動かないので, controlsへの変更が競合しない
+    async def append_message(self, topic: Topics, message: Message):
+        logger.debug("{} received topic: {}", self.__class__.__name__, topic)
         self.controller.add_new_message(self.controls, message)
 
-    def update_message_streamly(self, topic: Topics, message: Message):
-        # logger.debug(f"{self.__class__.__name__} received topic: {topic}")
+    async def update_message_streamly(self, topic: Topics, message: Message):
+        # logger.debug("{} received topic: {}", self.__class__.__name__, topic)
         self.controller.update_message_streamly(self.controls, message)
 
-    def restore_past_chat(self, topic: Topics, chat_id: str):
-        logger.debug(f"{self.__class__.__name__} received topic: {topic}")
+    async def restore_past_chat(self, topic: Topics, chat_id: str):
+        logger.debug("{} received topic: {}", self.__class__.__name__, topic)
         self.controller.restore_past_chat(chat_id)
 
-    def new_chat(self, topic: Topics, chat_id: str):
-        logger.debug(f"{self.__class__.__name__} received topic: {topic}")
+    async def new_chat(self, topic: Topics, chat_id: str):
+        logger.debug("{} received topic: {}", self.__class__.__name__, topic)
         self.controller.clear_controls()
 
 
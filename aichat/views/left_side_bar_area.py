@@ -1,10 +1,11 @@
-import uuid
+import secrets
 
 import flet as ft
 from loguru import logger
 
 from agents import Agent, all_models, get_agent_by_model
 from controllers.left_side_bar_controller import PastChatListController
+from models.chat import Chat
 from topics import Topics
 
 
@@ -23,7 +24,7 @@ class NewChatButton(ft.IconButton):
 
     def on_click_func(self, e: ft.ControlEvent):
         logger.info(f"{self.__class__.__name__} published topic: {Topics.NEW_CHAT}")
-        self.session.set("chat_id", str(uuid.uuid4()))
+        self.session.set("chat_id", secrets.token_hex(16))
         self.pubsub.send_all_on_topic(Topics.NEW_CHAT, None)
 
 
@@ -51,22 +52,22 @@ class ModelSelector(ft.Dropdown):
 
 
 class PastChatItem(ft.ListTile):
-    def __init__(self, page: ft.Page, chat_id: int, text: str):
+    def __init__(self, page: ft.Page, chat: Chat):
         super().__init__()
 
         self.page = page
         self.pubsub = page.pubsub
         self.session = page.session
-        self.chat_id = chat_id
+        self.chat_id = chat.id
 
         self.expand = True
-        self.text = text
+        self.text = chat.title
         self.padding = ft.padding.only(left=0, right=10, top=10, bottom=10)
         self.content_padding = 0
         self.spacing = 10
 
         self.leading = ft.Icon(ft.Icons.NOTES_ROUNDED, color=ft.Colors.WHITE70, size=13)
-        self.title = ft.Text(text[:16], color=ft.Colors.WHITE, size=13)
+        self.title = ft.Text(self.text[:16], color=ft.Colors.WHITE, size=13)
         self.dense = (True,)
         self.on_click = self.on_click_func
         self.on_hover = self.on_hover_func
@@ -76,11 +77,17 @@ class PastChatItem(ft.ListTile):
         self.pubsub.send_all_on_topic(Topics.PAST_CHAT_RESTORED, self.chat_id)
 
     def on_hover_func(self, e: ft.HoverEvent):
-        if self.page.theme_mode == ft.ThemeMode.LIGHT:
-            self.bgcolor = ft.Colors.GREEN_50 if e.data == "true" else None
+        if e.data != "true":
+            bgcolor = None
+        elif self.page.theme_mode == ft.ThemeMode.LIGHT:
+            bgcolor = ft.Colors.GREEN_50
         else:
-            self.bgcolor = ft.Colors.GREY_900 if e.data == "true" else None
-        self.update()
+            bgcolor = ft.Colors.GREY_900
+
+        # 色が変わらないイベントでは画面を更新しない
+        if bgcolor != self.bgcolor:
+            self.bgcolor = bgcolor
+            self.update()
 
 
 class PastChatList(ft.ListView):
@@ -93,10 +100,8 @@ class PastChatList(ft.ListView):
         self.controller = PastChatListController(
             update_view_callback=self.update_view_func, item_builder=PastChatItem
         )
-        self.controls = [
-            PastChatItem(page, ch.id, ch.title)
-            for ch in self.controller.collect_all_chat()
-        ]
+        self.controls = self.controller.build_chat_items(page)
+        self.on_scroll = self.on_scroll_func
 
         page.pubsub.subscribe_topic(Topics.UPDATE_CHAT, self._update_controls)
 
@@ -104,8 +109,19 @@ class PastChatList(ft.ListView):
         self.controls = controls
         self.update()
 
-    def _update_controls(self, topic: Topics, data: list):
-        logger.debug(f"{self.__class__.__name__} received topic: {topic}")
+    # スクロールとUPDATE_CHATのハンドラーをasyncにしてページのイベントループ上で順番に実行させる
+    # スレッドプールで並行に動くと, 一覧の作り直しと追加読み込みが競合する
+    async def on_scroll_func(self, e: ft.OnScrollEvent):
+        # 末尾に近づいたら次のページを読み込む
+        if e.pixels < e.max_scroll_extent - 200:
+            return
+
+        if items := self.controller.load_more_chat_items(self.page):
+            self.controls.extend(items)
+            self.update()
+
+    async def _update_controls(self, topic: Topics, data: list):
+        logger.debug("{} received topic: {}", self.__class__.__name__, topic)
         self.controller.update_chat_list(self.page)
 
 
@@ -30,9 +30,9 @@ class _MessageInputArea(ft.TextField):
         self.on_submit = self.on_submit_func
 
     def update(self):
-        logger.debug(f"{self.__class__.__name__} updating")
+        logger.debug("{} updating", self.__class__.__name__)
         super().update()
-        logger.debug(f"{self.__class__.__name__} updated")
+        logger.debug("{} updated", self.__class__.__name__)
 
     def on_submit_func(self, e: ft.ControlEvent):
         self.controller.send_message(self.session.get("chat_id"), e.control.value)
@@ -56,9 +56,9 @@ class _FileLoader(ft.FilePicker):
             pubsub=page.pubsub, update_view_callback=self.update
         )
 
-    def on_result_func(self, e: ft.FilePickerResultEvent):
-        logger.debug(f"Uploaded files: {e.files}")
-        self.controller.append_files(e=e, chat_id=self.session.get("chat_id"))
+    async def on_result_func(self, e: ft.FilePickerResultEvent):
+        logger.debug("Uploaded files: {}", e.files)
+        await self.controller.append_files(e=e, chat_id=self.session.get("chat_id"))
 
 
 class UserMessageArea(ft.Row):
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# アプリのモジュールは aichat/ 直下からimportされる前提なので, テストでも同じにする
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "aichat"))
@@ -0,0 +1,157 @@
+from pathlib import Path
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+from database.db import SQLiteDB
+from models.chat import Chat
+from models.message import ContentType, Message
+from models.role import Role
+
+
+class TempDBTestCase(unittest.TestCase):
+    """一時ディレクトリのDBを使うテスト"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_name = str(Path(self.tmpdir.name) / "test.db")
+        patcher = mock.patch.multiple(config, IS_DEBUG=True, DEBUG_DB_NAME=self.db_name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Chat._fetch_page.cache_clear()
+
+    def tearDown(self):
+        conn = SQLiteDB._connections.pop(self.db_name, None)
+        if conn is not None:
+            conn.close()
+        self.tmpdir.cleanup()
+
+    def _chat_ids(self) -> list[str]:
+        with sqlite3.connect(self.db_name) as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM chat")]
+
+
+class MessageBulkInsertTest(TempDBTestCase):
+    def test_failed_message_insert_leaves_no_chat_on_fresh_db(self):
+        role = Role.intern(config.USER_NAME)
+        # created_atはNOT NULLなので, メッセージのINSERTだけが失敗する
+        broken = Message(
+            "m1", "c1", None, "hello", "hello", ContentType.TEXT, role  # type: ignore
+        )
+
+        with self.assertRaises(sqlite3.IntegrityError):
+            Message.bulk_insert([broken])
+
+        self.assertEqual(self._chat_ids(), [])
+
+        # テーブルは作成済みのまま, 続く保存は成功する
+        Message.bulk_insert([Message.construct_auto("c1", "hello", role)])
+        self.assertEqual(self._chat_ids(), ["c1"])
+        self.assertEqual(
+            [m.display_content for m in Message.get_all_by_chat_id("c1")], ["hello"]
+        )
+
+
+class MessageBlobTest(TempDBTestCase):
+    def _image_message(self) -> Message:
+        msg = Message.construct_auto_file(
+            "c1",
+            display_content="File Uploaded: a.png",
+            system_content="",
+            content_type=ContentType.PNG,
+            role=Role.intern(config.APP_ROLE_NAME),
+        )
+        msg.store_blob(b"\x89PNG dummy")
+        return msg
+
+    def test_blob_is_stored_next_to_db(self):
+        msg = self._image_message()
+        Message.bulk_insert([msg])
+
+        digest = msg.blob_ref.removeprefix("blob:")
+        self.assertTrue(
+            (Path(self.tmpdir.name) / config.DEBUG_BLOB_DIR / digest).exists()
+        )
+
+    def test_missing_blob_restores_as_text(self):
+        msg = self._image_message()
+        Message.bulk_insert([msg])
+        (Path(self.tmpdir.name) / config.DEBUG_BLOB_DIR / msg.blob_ref[5:]).unlink()
+
+        [restored] = Message.get_all_by_chat_id("c1")
+
+        self.assertEqual(restored.content_type, ContentType.TEXT)
+        self.assertIn("a.png", restored.system_content)
+
+    def test_text_starting_with_blob_prefix_is_not_resolved(self):
+        (Path(self.tmpdir.name) / "secret.txt").write_text("secret")
+        # blobディレクトリがある状態で読む
+        Message.bulk_insert([self._image_message()])
+        texts = ["blob: what is a blob?", "blob:../secret.txt", "blob:"]
+        role = Role.intern(config.USER_NAME)
+        Message.bulk_insert([Message.construct_auto("c2", t, role) for t in texts])
+
+        restored = list(Message.get_all_by_chat_id("c2"))
+
+        self.assertCountEqual([m.system_content for m in restored], texts)
+        self.assertEqual({m.content_type for m in restored}, {ContentType.TEXT})
+
+    def test_image_ref_must_be_a_digest(self):
+        msg = self._image_message()
+        msg.blob_ref = "blob:../secret.txt"
+        (Path(self.tmpdir.name) / "secret.txt").write_text("secret")
+        Message.bulk_insert([msg])
+
+        [restored] = Message.get_all_by_chat_id("c1")
+
+        self.assertEqual(restored.system_content, "blob:../secret.txt")
+
+    def test_failed_blob_write_leaves_no_file(self):
+        blob_dir = Path(self.tmpdir.name) / config.DEBUG_BLOB_DIR
+
+        with mock.patch("os.replace", side_effect=OSError("disk full")):
+            with self.assertRaises(OSError):
+                self._image_message()
+
+        self.assertEqual(list(blob_dir.iterdir()), [])
+        # 次の保存では書き込みからやり直す
+        msg = self._image_message()
+        self.assertEqual(
+            [p.name for p in blob_dir.iterdir()], [msg.blob_ref.removeprefix("blob:")]
+        )
+
+
+class CachedRequestTest(unittest.TestCase):
+    def setUp(self):
+        self.message = Message.construct_auto(
+            "c1", "hel", Role.intern(config.USER_NAME)
+        )
+        self.build = mock.Mock(side_effect=lambda m: {"content": m.system_content})
+
+    def test_reused_while_content_is_unchanged(self):
+        first = self.message.cached_request("agent", self.build)
+
+        self.assertIs(self.message.cached_request("agent", self.build), first)
+        self.build.assert_called_once()
+
+    def test_rebuilt_after_streamed_content_grows(self):
+        self.message.cached_request("agent", self.build)
+        self.message.system_content = "hello"
+
+        request = self.message.cached_request("agent", self.build)
+
+        self.assertEqual(request, {"content": "hello"})
+        self.assertEqual(self.build.call_count, 2)
+
+    def test_keys_are_separate(self):
+        self.message.cached_request("a", self.build)
+        self.message.cached_request("b", lambda m: "other")
+
+        self.assertEqual(self.message.cached_request("b", self.build), "other")
+        self.build.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,115 @@
+import asyncio
+from pathlib import Path
+import tempfile
+from types import SimpleNamespace
+import unittest
+from unittest import mock
+
+import config
+from controllers.message_input_controller import FileLoaderController
+from models.message import ContentType, Message
+
+
+class LoadTextTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.controller = FileLoaderController(None, lambda: None)  # type: ignore
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, raw: bytes) -> str:
+        path = Path(self.tmpdir.name) / "input.txt"
+        path.write_bytes(raw)
+        messages = asyncio.run(self.controller._load_text(path, "chat"))
+
+        return messages[0].system_content
+
+    def test_short_utf8(self):
+        for text in ["€100", "héllo wörld"]:
+            with self.subTest(text=text):
+                self.assertEqual(self._load(text.encode("utf-8")), text)
+
+    def test_utf8_with_bom(self):
+        self.assertEqual(self._load("héllo".encode("utf-8-sig")), "héllo")
+
+    def test_cp932(self):
+        text = "これは日本語のテキストファイルです。文字コードはシフトJISで保存しています。"
+        self.assertEqual(self._load(text.encode("cp932")), text)
+
+    def test_latin1(self):
+        text = "Café crème brûlée, déjà vu. Ça va très bien à Noël, garçon."
+        self.assertEqual(self._load(text.encode("latin-1")), text)
+
+    def test_empty(self):
+        self.assertEqual(self._load(b""), "")
+
+
+class AppendFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.pubsub = mock.Mock()
+        self.controller = FileLoaderController(self.pubsub, lambda: None)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_failed_file_does_not_drop_others(self):
+        ok = Path(self.tmpdir.name) / "ok.txt"
+        ok.write_text("hello", encoding="utf-8")
+        missing = Path(self.tmpdir.name) / "missing"
+        event = SimpleNamespace(
+            files=[SimpleNamespace(path=str(missing)), SimpleNamespace(path=str(ok))]
+        )
+
+        with mock.patch.object(Message, "bulk_insert") as bulk_insert:
+            asyncio.run(self.controller.append_files(event, "chat"))  # type: ignore
+
+        [messages] = bulk_insert.call_args.args
+        self.assertEqual([m.system_content for m in messages], ["hello"])
+        self.pubsub.send_all_on_topic.assert_called_once()
+
+
+class PdfCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache_dir = Path(self.tmpdir.name) / "cache"
+        patcher = mock.patch.object(config, "OCR_CACHE_DIR", str(self.cache_dir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.controller = FileLoaderController(None, lambda: None)  # type: ignore
+        self.pdf = Path(self.tmpdir.name) / "a.pdf"
+        self.pdf.write_bytes(b"%PDF-1.4 dummy")
+        self.parsed = [("File Uploaded: a.pdf", "text", ContentType.TEXT)]
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def _load(self, parser: mock.AsyncMock):
+        return asyncio.run(
+            self.controller._load_pdf_contents(self.pdf, "-test", parser)
+        )
+
+    def test_cache_is_reused(self):
+        parser = mock.AsyncMock(return_value=self.parsed)
+
+        self.assertEqual(self._load(parser), self.parsed)
+        self.assertEqual(self._load(parser), self.parsed)
+        parser.assert_awaited_once()
+        # 一時ファイルは残らない
+        self.assertEqual(len(list(self.cache_dir.iterdir())), 1)
+
+    def test_broken_cache_is_parsed_again(self):
+        self._load(mock.AsyncMock(return_value=self.parsed))
+        [cache_path] = self.cache_dir.iterdir()
+        cache_path.write_text('[["File Uploaded', encoding="utf-8")
+        parser = mock.AsyncMock(return_value=self.parsed)
+
+        self.assertEqual(self._load(parser), self.parsed)
+        parser.assert_awaited_once()
+        self.assertEqual(self._load(parser), self.parsed)
+        parser.assert_awaited_once()
+
+
+if __name__ == "__main__":
+    unittest.main()